@@ -1,12 +1,23 @@
 import os
 import sqlite3
-import json
-from flask import Flask, jsonify, request, session, send_from_directory, Response
+import orjson
+import queue
+import contextlib
+import threading
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+import re
+from flask import Flask, jsonify, request, session, send_from_directory, Response, stream_with_context
+from flask.json.provider import JSONProvider
 from flask_session import Session
+import redis
 import random
-from datetime import datetime, timedelta
+from datetime import datetime
 import pandas as pd
+import numpy as np
 import io
+import csv
+import zlib
 import google.generativeai as genai
 import matplotlib
 matplotlib.use('Agg')
@@ -15,24 +26,95 @@ import base64
 from collections import Counter
 
 # --- App Configuration ---
+class OrjsonProvider(JSONProvider):
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 app.config["SECRET_KEY"] = os.urandom(24)
-app.config["SESSION_TYPE"] = "filesystem"
+app.config["SESSION_TYPE"] = "redis"
+app.config["SESSION_REDIS"] = redis.Redis(
+    host=os.environ.get("REDIS_HOST", "localhost"),
+    port=int(os.environ.get("REDIS_PORT", 6379)),
+    decode_responses=False
+)
 app.config["SESSION_PERMANENT"] = False
 Session(app)
 
 # --- Database Setup ---
 DB_FILE = "database.db"
+# Secondary indexes on transactions; the flagged one serves the alerts feed as a range scan instead of filter + sort
+INDEXES = {
+    "idx_flagged_ts": "CREATE INDEX idx_flagged_ts ON transactions (is_flagged, timestamp DESC)",
+}
+# Kept as one constant string so sqlite3's per-connection statement cache reuses the compiled statement
+INSERT_SQL = (
+    "INSERT INTO transactions (timestamp, user_id, amount, currency, description, user_location, transaction_location, is_flagged, flag_reason, anomaly_score) "
+    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+)
 
 SANCTIONED_ENTITIES = ["Monitored Entity Alpha", "High-Risk Corp Beta", "Watchlist Inc. Gamma", "Global Oversight Ltd."]
 USER_LOCATIONS = {"user123": "New York", "user456": "London", "user789": "Tokyo"}
 TRANSACTION_LOCATIONS = ["New York", "London", "Tokyo", "Moscow", "Beijing", "Cayman Islands"]
 HIGH_RISK_LOCATIONS = ["Moscow", "Cayman Islands"]
+HIGH_RISK_SET = frozenset(HIGH_RISK_LOCATIONS)
+UNUSUAL_HOURS_START = pd.Timedelta(hours=1)
+UNUSUAL_HOURS_END = pd.Timedelta(hours=5)
+SANCTION_RE = re.compile("|".join(re.escape(entity) for entity in SANCTIONED_ENTITIES))
+
+# Placeholders sent to the LLM in place of sensitive values; longest keys first so overlaps resolve greedily
+MASK = {
+    "Sanctioned Entity": "[Reason: Monitored Entity]",
+    "Risky Geolocation": "[Reason: High-Risk Location]",
+    **{loc: f"[Location-{chr(65+i)}]" for i, loc in enumerate(HIGH_RISK_LOCATIONS)},
+    **{ent: f"[Entity-{chr(88+i)}]" for i, ent in enumerate(SANCTIONED_ENTITIES)}
+}
+UNMASK = {v: k for k, v in MASK.items()}
+MASK_RE = re.compile("|".join(re.escape(k) for k in sorted(MASK, key=len, reverse=True)))
+UNMASK_RE = re.compile("|".join(re.escape(k) for k in sorted(UNMASK, key=len, reverse=True)))
+
+rng = np.random.default_rng()
+
+# Idle connections shared by all threads; the dev server starts a fresh thread per request,
+# so connections must outlive the thread that opened them to keep their page cache warm
+POOL_SIZE = 8
+_pool = queue.LifoQueue(maxsize=POOL_SIZE)
+
+def open_conn():
+    conn = sqlite3.connect(DB_FILE, check_same_thread=False, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA cache_size=-65536")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    return conn
+
+@contextlib.contextmanager
+def get_conn():
+    """Check a connection out of the pool, opening one if none is idle, and return it afterwards."""
+    try:
+        conn = _pool.get_nowait()
+    except queue.Empty:
+        conn = open_conn()
+    try:
+        yield conn
+    finally:
+        try:
+            _pool.put_nowait(conn)
+        except queue.Full:
+            conn.close()
 
 def init_db():
-    if os.path.exists(DB_FILE):
-        os.remove(DB_FILE)
+    # In WAL mode a leftover -wal file would be replayed onto the fresh database, so drop it too
+    for path in (DB_FILE, DB_FILE + "-wal", DB_FILE + "-shm"):
+        if os.path.exists(path):
+            os.remove(path)
     conn = sqlite3.connect(DB_FILE)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
     cursor = conn.cursor()
     cursor.execute('''
         CREATE TABLE transactions (
@@ -49,64 +131,147 @@ def init_db():
             anomaly_score REAL DEFAULT 0
         )
     ''')
+    for create_sql in INDEXES.values():
+        cursor.execute(create_sql)
+    # Dashboard counters, maintained incrementally by simulate_transactions
+    cursor.execute('''
+        CREATE TABLE stats (
+            total_alerts INTEGER NOT NULL DEFAULT 0,
+            high_risk_count INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    cursor.execute("INSERT INTO stats (total_alerts, high_risk_count) VALUES (0, 0)")
     conn.commit()
     conn.close()
 
 # --- Core Logic: Rules Engine & Anomaly Detector ---
 
-def apply_rules_engine(transaction):
-    flags = []
-    score = 0
-    tx_time = datetime.strptime(transaction['timestamp'], '%Y-%m-%d %H:%M:%S').time()
-    if tx_time >= datetime.strptime('01:00:00', '%H:%M:%S').time() and tx_time <= datetime.strptime('05:00:00', '%H:%M:%S').time():
-        flags.append("Unusual Hours")
-        score += 25
-    if transaction['user_location'] != transaction['transaction_location']:
-        flags.append("Geolocation Mismatch")
-        score += 40
-    if any(entity in transaction['description'] for entity in SANCTIONED_ENTITIES):
-        flags.append("Sanctioned Entity")
-        score += 100
-    if transaction['amount'] > 10000:
-        flags.append("High Amount")
-        score += 30
-    if random.random() < 0.05: # Simulate random high velocity
-        flags.append("High Velocity")
-        score += 50
-    if transaction['transaction_location'] in HIGH_RISK_LOCATIONS:
-        flags.append("Risky Geolocation")
-        score += 60
-    return flags, score
+# Bit i of a flag mask is set when FLAG_NAMES[i] fired; REASON_TABLE maps each mask to its flag_reason
+FLAG_NAMES = ["Unusual Hours", "Geolocation Mismatch", "Sanctioned Entity", "High Amount", "High Velocity", "Risky Geolocation"]
+REASON_TABLE = [", ".join(name for i, name in enumerate(FLAG_NAMES) if mask >> i & 1) or None for mask in range(1 << len(FLAG_NAMES))]
+
+def apply_rules_engine(df):
+    """Evaluate every rule over a batch of transactions at once.
+
+    Returns a (flag_mask, anomaly_score) pair of integer Series aligned with df.
+    """
+    time_of_day = df['timestamp'] - df['timestamp'].dt.normalize()
+    rules = [ # (points, hit) in FLAG_NAMES order
+        (25, time_of_day.between(UNUSUAL_HOURS_START, UNUSUAL_HOURS_END)),
+        (40, df['user_location'].ne(df['transaction_location'])),
+        (100, df['description'].str.contains(SANCTION_RE)),
+        (30, df['amount'].gt(10000)),
+        (50, pd.Series(rng.random(len(df)) < 0.05, index=df.index)), # Simulate random high velocity
+        (60, df['transaction_location'].isin(HIGH_RISK_SET)),
+    ]
+    score = sum(hit.astype(int) * points for points, hit in rules)
+    flag_mask = sum(hit.astype(int) * (1 << bit) for bit, (_, hit) in enumerate(rules))
+    return flag_mask, score
+
+# --- AI Assistant ---
+
+SYSTEM_INSTRUCTION = (
+    "*Simulation Context:* You are an AI assistant for a financial compliance officer in a training simulation. "
+    "The user's data contains placeholders like [Reason:...], [Location-..], and [Entity-..] to mask sensitive information. "
+    "Analyze the data, including these placeholders, and answer the user's request. "
+    "Use the placeholders in your response exactly as they appear in the provided data."
+)
+
+# A GenerativeModel binds whatever client genai.configure() last set up on its first
+# generate_content call, so binding happens under GEMINI_LOCK and the bound model is
+# cached by a hash of its key (never the raw key) until that user logs out
+GEMINI_CACHE_SIZE = 32
+GEMINI_MODELS = {}
+GEMINI_LOCK = threading.Lock()
+
+def gemini_key_id(api_key):
+    return hashlib.sha256(api_key.encode('utf-8')).hexdigest()
+
+def generate_with_gemini(api_key, prompt):
+    key_id = gemini_key_id(api_key)
+    model = GEMINI_MODELS.get(key_id)
+    if model is not None:
+        return model.generate_content(prompt)
+    with GEMINI_LOCK:
+        genai.configure(api_key=api_key)
+        model = genai.GenerativeModel(model_name='gemini-2.5-flash', system_instruction=SYSTEM_INSTRUCTION)
+        response = model.generate_content(prompt)
+        if len(GEMINI_MODELS) >= GEMINI_CACHE_SIZE:
+            GEMINI_MODELS.pop(next(iter(GEMINI_MODELS)))
+        GEMINI_MODELS[key_id] = model
+    return response
+
+def forget_gemini_model(api_key):
+    with GEMINI_LOCK:
+        GEMINI_MODELS.pop(gemini_key_id(api_key), None)
+
+def mask_sensitive(node):
+    """Recursively replace sensitive values in the string leaves of a JSON-like structure."""
+    if isinstance(node, str):
+        return MASK_RE.sub(lambda m: MASK[m.group(0)], node)
+    if isinstance(node, dict):
+        return {k: mask_sensitive(v) for k, v in node.items()}
+    if isinstance(node, list):
+        return [mask_sensitive(x) for x in node]
+    return node
 
 # --- Data Simulation ---
 
-def simulate_transactions(count=5):
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    for _ in range(count):
-        user_id = random.choice(list(USER_LOCATIONS.keys()))
-        transaction = {
-            'timestamp': (datetime.now() - timedelta(minutes=random.randint(0, 60))).strftime('%Y-%m-%d %H:%M:%S'),
-            'user_id': user_id,
-            'amount': round(random.uniform(5.0, 20000.0), 2),
-            'currency': 'USD',
-            'description': f"Payment to {random.choice(SANCTIONED_ENTITIES + ['GoodCorp', 'Service XYZ', 'OnlineStore'])} from {user_id}",
-            'user_location': USER_LOCATIONS[user_id],
-            'transaction_location': random.choice(TRANSACTION_LOCATIONS)
-        }
-        flags, score = apply_rules_engine(transaction)
-        is_flagged = 1 if flags else 0
-        flag_reason = ', '.join(flags) if flags else None
-        cursor.execute('''
-            INSERT INTO transactions (timestamp, user_id, amount, currency, description, user_location, transaction_location, is_flagged, flag_reason, anomaly_score)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (
-            transaction['timestamp'], transaction['user_id'], transaction['amount'], transaction['currency'],
-            transaction['description'], transaction['user_location'], transaction['transaction_location'],
-            is_flagged, flag_reason, score
-        ))
-    conn.commit()
-    conn.close()
+def simulate_transactions(count=5, rebuild_indexes=False):
+    user_ids = rng.choice(list(USER_LOCATIONS), size=count)
+    timestamps = pd.Timestamp.now().floor('s') - pd.to_timedelta(rng.integers(0, 60, size=count, endpoint=True), unit='m')
+    entities = rng.choice(SANCTIONED_ENTITIES + ['GoodCorp', 'Service XYZ', 'OnlineStore'], size=count)
+    df = pd.DataFrame({
+        'timestamp': timestamps,
+        'user_id': user_ids,
+        'amount': np.round(rng.uniform(5.0, 20000.0, size=count), 2),
+        'currency': 'USD',
+        'description': 'Payment to ' + pd.Series(entities) + ' from ' + pd.Series(user_ids),
+        'user_location': pd.Series(user_ids).map(USER_LOCATIONS),
+        'transaction_location': rng.choice(TRANSACTION_LOCATIONS, size=count),
+    })
+    flag_mask, score = apply_rules_engine(df)
+    is_flagged = flag_mask.ne(0).astype(int)
+    flagged_count = int(is_flagged.sum())
+    high_risk_count = int(score.ge(90).sum())
+    # tolist() hands sqlite native Python ints/floats rather than numpy scalars
+    rows = list(zip(
+        df['timestamp'].dt.strftime('%Y-%m-%d %H:%M:%S').tolist(), df['user_id'].tolist(), df['amount'].tolist(), df['currency'].tolist(),
+        df['description'].tolist(), df['user_location'].tolist(), df['transaction_location'].tolist(),
+        is_flagged.tolist(), [REASON_TABLE[mask] for mask in flag_mask.tolist()], score.tolist()
+    ))
+    # One explicit transaction for the whole batch instead of per-row journal work
+    with get_conn() as conn:
+        cursor = conn.cursor()
+        cursor.execute("BEGIN")
+        try:
+            if rebuild_indexes:
+                for name in INDEXES:
+                    cursor.execute(f"DROP INDEX IF EXISTS {name}")
+            cursor.executemany(INSERT_SQL, rows)
+            if rebuild_indexes:
+                for create_sql in INDEXES.values():
+                    cursor.execute(create_sql)
+            cursor.execute(
+                "UPDATE stats SET total_alerts = total_alerts + :f, high_risk_count = high_risk_count + :h",
+                {'f': flagged_count, 'h': high_risk_count}
+            )
+            cursor.execute("COMMIT")
+        except Exception:
+            # Pooled connections are reused, so never hand one back mid-transaction
+            cursor.execute("ROLLBACK")
+            raise
+
+def bulk_simulate(count):
+    """Seed a large batch, building the secondary indexes once after the insert instead of row by row."""
+    simulate_transactions(count, rebuild_indexes=True)
+
+# Single background writer so /api/alerts never waits on inserts
+EXECUTOR = ThreadPoolExecutor(max_workers=1)
+
+def report_simulation_error(future):
+    if future.exception() is not None:
+        print(f"Transaction simulation error: {future.exception()}")
 
 # --- Dashboard Generation Helpers ---
 
@@ -224,6 +389,15 @@ def generate_dashboard_html(fig1_b64, fig2_b64, stats):
     </body>
     </html>"""
 
+def gzip_stream(chunks):
+    """Compress an iterable of text chunks into a gzip byte stream as it is consumed."""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode('utf-8'))
+        if data:
+            yield data
+    yield compressor.flush()
+
 # --- API Routes ---
 
 @app.route('/')
@@ -242,6 +416,8 @@ def login():
 
 @app.route('/api/logout', methods=['POST'])
 def logout():
+    if session.get('gemini_api_key'):
+        forget_gemini_model(session['gemini_api_key'])
     session.clear()
     return jsonify({'status': 'success'})
 
@@ -254,17 +430,14 @@ def check_session():
 @app.route('/api/alerts')
 def get_alerts():
     if not session.get('logged_in'): return jsonify({'error': 'Unauthorized'}), 401
-    simulate_transactions(random.randint(1, 4))
-    conn = sqlite3.connect(DB_FILE)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM transactions WHERE is_flagged = 1 ORDER BY timestamp DESC LIMIT 100")
-    alerts = [dict(row) for row in cursor.fetchall()]
-    cursor.execute("SELECT COUNT(*) FROM transactions WHERE is_flagged = 1")
-    total_alerts = cursor.fetchone()[0]
-    cursor.execute("SELECT COUNT(*) FROM transactions WHERE anomaly_score >= 90")
-    high_risk_count = cursor.fetchone()[0]
-    conn.close()
+    EXECUTOR.submit(simulate_transactions, random.randint(1, 4)).add_done_callback(report_simulation_error)
+    with get_conn() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT * FROM transactions WHERE is_flagged = 1 ORDER BY timestamp DESC LIMIT 100")
+        cols = [col[0] for col in cursor.description]
+        alerts = [dict(zip(cols, row)) for row in cursor.fetchall()]
+        cursor.execute("SELECT total_alerts, high_risk_count FROM stats")
+        total_alerts, high_risk_count = cursor.fetchone()
     stats = {'totalAlerts': total_alerts, 'highRiskCount': high_risk_count, 'lastUpdated': datetime.now().strftime('%H:%M:%S')}
     return jsonify({'alerts': alerts, 'stats': stats})
 
@@ -285,13 +458,8 @@ def chat_with_ai():
             return jsonify({'response': "There's no data to visualize. Please wait for some alerts to be generated."})
         try:
             df = pd.DataFrame(context_data)
-            conn = sqlite3.connect(DB_FILE)
-            cursor = conn.cursor()
-            cursor.execute("SELECT COUNT(*) FROM transactions WHERE is_flagged = 1")
-            total_alerts = cursor.fetchone()[0]
-            cursor.execute("SELECT COUNT(*) FROM transactions WHERE anomaly_score >= 90")
-            high_risk_count = cursor.fetchone()[0]
-            conn.close()
+            with get_conn() as conn:
+                total_alerts, high_risk_count = conn.execute("SELECT total_alerts, high_risk_count FROM stats").fetchone()
             stats = {'totalAlerts': total_alerts, 'highRiskCount': high_risk_count}
 
             fig1_b64, fig2_b64 = generate_charts(df)
@@ -301,35 +469,15 @@ def chat_with_ai():
             print(f"Dashboard generation error: {e}")
             return jsonify({'error': f'Failed to generate dashboard: {str(e)}'}), 500
 
-    mask = {
-        "Sanctioned Entity": "[Reason: Monitored Entity]",
-        "Risky Geolocation": "[Reason: High-Risk Location]",
-        **{loc: f"[Location-{chr(65+i)}]".format(i) for i, loc in enumerate(HIGH_RISK_LOCATIONS)},
-        **{ent: f"[Entity-{chr(88+i)}]".format(i) for i, ent in enumerate(SANCTIONED_ENTITIES)}
-    }
-    unmask = {v: k for k, v in mask.items()}
-
-    masked_context_str = json.dumps(context_data)
-    for original, placeholder in mask.items():
-        masked_context_str = masked_context_str.replace(original, placeholder)
+    masked_context_str = orjson.dumps(mask_sensitive(context_data)).decode()
 
     try:
-        genai.configure(api_key=session.get('gemini_api_key'))
-        system_instruction = (
-            "*Simulation Context:* You are an AI assistant for a financial compliance officer in a training simulation. "
-            "The user's data contains placeholders like [Reason:...], [Location-..], and [Entity-..] to mask sensitive information. "
-            "Analyze the data, including these placeholders, and answer the user's request. "
-            "Use the placeholders in your response exactly as they appear in the provided data."
-        )
-        model = genai.GenerativeModel(model_name='gemini-2.5-flash', system_instruction=system_instruction)
         prompt = (
             f"Masked Transaction Data:\n{masked_context_str}\n\n"
             f"USER INQUIRY: {user_message}"
         )
-        response = model.generate_content(prompt)
-        ai_response = response.text
-        for placeholder, original in unmask.items():
-            ai_response = ai_response.replace(placeholder, original)
+        response = generate_with_gemini(session.get('gemini_api_key'), prompt)
+        ai_response = UNMASK_RE.sub(lambda m: UNMASK[m.group(0)], response.text)
 
         return jsonify({'response': ai_response})
 
@@ -340,17 +488,31 @@ def chat_with_ai():
 @app.route('/api/export')
 def export_report():
     if not session.get('logged_in'): return jsonify({'error': 'Unauthorized'}), 401
-    conn = sqlite3.connect(DB_FILE)
-    db_df = pd.read_sql_query("SELECT * FROM transactions WHERE is_flagged = 1 ORDER BY timestamp DESC", conn)
-    conn.close()
-    csv_buffer = io.StringIO()
-    db_df.to_csv(csv_buffer, index=False)
-    return Response(
-        csv_buffer.getvalue(),
-        mimetype="text/csv",
-        headers={"Content-disposition": f"attachment; filename=compliance_report_{datetime.now().strftime('%Y%m%d')}.csv"}
-    )
+    def generate():
+        # The connection is held for as long as the response streams and returned when it ends
+        with get_conn() as conn, contextlib.closing(conn.cursor()) as cursor:
+            cursor.execute("SELECT * FROM transactions WHERE is_flagged = 1 ORDER BY timestamp DESC")
+            # Reuse one small buffer so memory stays flat regardless of the result size
+            buffer = io.StringIO()
+            writer = csv.writer(buffer, lineterminator='\n')
+            writer.writerow([col[0] for col in cursor.description])
+            for row in cursor:
+                writer.writerow(row)
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate(0)
+            yield buffer.getvalue()
+
+    body = generate()
+    headers = {"Content-disposition": f"attachment; filename=compliance_report_{datetime.now().strftime('%Y%m%d')}.csv", "Vary": "Accept-Encoding"}
+    if request.accept_encodings.quality('gzip') > 0:
+        body = gzip_stream(body)
+        headers["Content-Encoding"] = "gzip"
+    return Response(stream_with_context(body), mimetype="text/csv", headers=headers)
 
 if __name__ == '__main__':
     init_db()
+    seed_count = int(os.environ.get("SEED_TRANSACTIONS", 0))
+    if seed_count:
+        bulk_simulate(seed_count)
     app.run(host='0.0.0.0', port=5000)